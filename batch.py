@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import hashlib
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Environment variables read by the BLAS / OpenMP runtimes when numpy is imported.
+# Workers are spawned (not forked) so they pick these up on their own import.
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                   "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+def sequence_name(path):
+    # .../sequences/00 -> sequences_00_<hash>, a/car.mp4 -> a_car_<hash>
+    # the hash of the absolute path keeps same-named sequences apart
+    path = os.path.abspath(path)
+    parent, name = os.path.split(os.path.normpath(path))
+    digest = hashlib.md5(path.encode()).hexdigest()[:8]
+    return f"{os.path.basename(parent)}_{os.path.splitext(name)[0]}_{digest}"
+
+
+# loop closure vocabulary of this worker, loaded once and shared by its sequences
+_vocabulary = None
+
+
+def init_worker(threads, vocabulary_path=None):
+    global _vocabulary
+    import cv2
+    cv2.setNumThreads(threads)
+    if vocabulary_path is not None:
+        from loopclosure import Vocabulary
+        _vocabulary = Vocabulary.load(vocabulary_path)
+
+
+def run_sequence(path, out_dir, W, H, F, threads, cache_dir=None):
+    """Run one sequence headless and write its trajectory, map and report"""
+    import numpy as np
+    from framesource import open_source
+    from slam import SLAM
+
+    source = open_source(path, size=(W, H), workers=threads, cache_dir=cache_dir)
+    # KITTI sources keep their aspect ratio
+    W, H = source.size
+    K = source.K
+    if K is None:
+        K = np.array([[F, 0, W // 2], [0, F, H // 2], [0, 0, 1]])
+
+    slam = SLAM(W, H, K, viewer=False, vocabulary=_vocabulary)
+    start = time.perf_counter()
+    error = None
+    try:
+        for frame in source:
+            slam.process_frame(frame)
+        if slam.frame_counter == 0:
+            error = f"No frames read from {path}"
+    except Exception as e:
+        error = repr(e)
+
+    # outputs of a failed run are still useful, but the first error is the one reported
+    try:
+        slam.save(out_dir)
+    except Exception as e:
+        error = error or repr(e)
+    report = dict(slam.stats(), sequence=path, wall_time=time.perf_counter() - start, error=error)
+
+    # the report is written last: its presence marks the sequence as done
+    if error is None:
+        tmp_path = os.path.join(out_dir, "report.json.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(tmp_path, os.path.join(out_dir, "report.json"))
+    return report
+
+
+def run_batch(paths, out_root, workers=None, threads=1, W=1920//2, H=1080//2, F=450, cache_dir=None,
+              vocabulary=None):
+    """Process every sequence in its own worker process, skipping finished ones"""
+    workers = workers or max(os.cpu_count() // threads, 1)
+    os.makedirs(out_root, exist_ok=True)
+
+    reports = {}
+    todo = []
+    # the same sequence twice would have two workers writing the same folder
+    paths = list(dict.fromkeys(os.path.abspath(path) for path in paths))
+    for path in paths:
+        out_dir = os.path.join(out_root, sequence_name(path))
+        report_path = os.path.join(out_dir, "report.json")
+        if os.path.exists(report_path):
+            with open(report_path) as f:
+                reports[path] = json.load(f)
+            print(f"Skipping {path}, already done")
+        else:
+            todo.append((path, out_dir))
+
+    # Each worker gets `threads` cores, so BLAS / OpenCV must not spin up
+    # one thread per core in every process.
+    saved_env = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update({var: str(threads) for var in THREAD_ENV_VARS})
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_worker, initargs=(threads, vocabulary)) as pool:
+            futures = {pool.submit(run_sequence, path, out_dir, W, H, F, threads, cache_dir): path
+                       for path, out_dir in todo}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    reports[path] = future.result()
+                except Exception as e:
+                    reports[path] = {'sequence': path, 'error': repr(e)}
+                report = reports[path]
+                if report.get('error'):
+                    print(f"Failed {path}: {report['error']}")
+                else:
+                    print(f"Done {path}: {report['frames']} frames, {report['fps']:.1f} fps")
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+    wall_time = time.perf_counter() - start
+
+    # only the sequences processed in this run count towards the throughput
+    new_frames = sum(reports[path].get('frames', 0) for path, _ in todo)
+    summary = {
+        'workers': workers,
+        'threads_per_worker': threads,
+        'wall_time': wall_time,
+        'frames': new_frames,
+        'fps': new_frames / wall_time if todo and wall_time > 0 else 0.0,
+        'failed': [path for path, report in reports.items() if report.get('error')],
+        'sequences': reports,
+    }
+    with open(os.path.join(out_root, "summary.json"), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the SLAM pipeline over many sequences")
+    parser.add_argument("sequences", nargs="+", help="video files, KITTI sequence folders or image folders")
+    parser.add_argument("--out", default="output", help="one sub folder per sequence is written here")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: cores / threads)")
+    parser.add_argument("--threads", type=int, default=1, help="BLAS / OpenCV threads per worker")
+    parser.add_argument("--cache", default=None, help="decoded frame cache folder")
+    parser.add_argument("--vocabulary", default=None, help="pretrained loop closure vocabulary (.npz)")
+    args = parser.parse_args()
+
+    summary = run_batch(args.sequences, args.out, args.workers, args.threads, cache_dir=args.cache,
+                        vocabulary=args.vocabulary)
+    print(f"{summary['frames']} frames in {summary['wall_time']:.1f}s ({summary['fps']:.1f} fps)")
+    sys.exit(1 if summary['failed'] else 0)
@@ -13,7 +13,7 @@ def add_ones(x):
 
 IRt = np.eye(4)
 
-def extractPose(F):
+def extractPose(F, verbose=True):
     W = np.mat([[0,-1,0],[1,0,0],[0,0,1]])
     U,d,Vt = np.linalg.svd(F)
     assert np.linalg.det(U) > 0
@@ -26,14 +26,15 @@ def extractPose(F):
     ret = np.eye(4)
     ret[:3, :3] = R
     ret[:3, 3] = t
-    print(d)
+    if verbose:
+        print(d)
     return ret
 
 def extract(img):
     orb = cv2.ORB_create()
     
-    # Convert to grayscale
-    gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    # Convert to grayscale (frame sources may already deliver gray frames)
+    gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
 
     # Detection
     pts = cv2.goodFeaturesToTrack(gray_img, 8000, qualityLevel=0.01, minDistance=10)
@@ -70,7 +71,16 @@ class Matcher(object):
         self.last = None
 
 
-def match_frames(f1, f2):
+def fit_fundamental(ret, residual_threshold=0.005, max_trials=200):
+    # RANSAC fit of the fundamental matrix over normalized point pairs.
+    # `ret` is an N x 2 x 2 array of (p1, p2) correspondences.
+    return ransac((ret[:, 0], 
+                   ret[:, 1]), FundamentalMatrixTransform, 
+                   min_samples=8, residual_threshold=residual_threshold, 
+                   max_trials=max_trials)
+
+
+def match_frames(f1, f2, verbose=True):
     bf = cv2.BFMatcher(cv2.NORM_HAMMING)
     matches = bf.knnMatch(f1.des, f2.des, k=2)
 
@@ -99,23 +109,22 @@ def match_frames(f1, f2):
     idx2 = np.array(idx2)
 
     # Fit matrix
-    model, inliers = ransac((ret[:, 0], 
-                            ret[:, 1]), FundamentalMatrixTransform, 
-                            min_samples=8, residual_threshold=0.005, 
-                            max_trials=200)
+    model, inliers = fit_fundamental(ret)
     
     # Ignore outliers
     ret = ret[inliers]
-    Rt = extractPose(model.params)
+    Rt = extractPose(model.params, verbose)
 
     return idx1[inliers], idx2[inliers], Rt
 
 
 class Frame(object):
-    def __init__(self, mapp, img, K):
+    def __init__(self, mapp, img, K, index=None):
         self.K = K
+        self.index = index # position in the input sequence, when frames are skipped
         self.Kinv = np.linalg.inv(self.K)
         self.pose = IRt
+        self.map_points = {} # keypoint index -> Point observed at that keypoint
 
         self.id = len(mapp.frames)
         mapp.frames.append(self)
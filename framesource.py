@@ -0,0 +1,254 @@
+import os
+import glob
+import json
+import hashlib
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+import cv2
+import numpy as np
+from utils import read_calibration_file, extract_intrinsic_matrix
+
+
+def imread(path, flags):
+    # cv2.imread returns None instead of raising on unreadable files
+    img = cv2.imread(path, flags)
+    if img is None:
+        raise IOError(f"Cannot read {path}")
+    return img
+
+
+class FrameSource(object):
+    # Base class of everything the pipeline can read frames from.
+    # Frames are decoded ahead of the consumer in background threads and
+    # already come out resized (and grayscale unless gray=False), since
+    # `extract` only works on the gray image anyway.
+    #
+    # With a cache_dir, the decoded frames of the first full pass are stored
+    # in a raw uint8 file, and later runs memory-map it instead of decoding
+    # anything.
+
+    def __init__(self, name, size=None, gray=True, prefetch=8, workers=4, cache_dir=None):
+        self.name = name
+        self.size = size # (W, H) the frames are resized to, None keeps the native size
+        # (sources that know their frame size may adjust it, use `size` for the output)
+        self.gray = gray
+        self.prefetch = prefetch
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.K = None # intrinsics for the resized frames, when the source knows them
+        self.timestamp = None # capture time (time.perf_counter) of the last frame, when known
+
+    def __len__(self):
+        # number of frames, 0 when unknown (live camera)
+        return 0
+
+    def backlog(self):
+        # frames already decoded and waiting behind the last one
+        return 0
+
+    def prepare(self, img):
+        if self.gray and img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if self.size is not None and (img.shape[1], img.shape[0]) != tuple(self.size):
+            img = cv2.resize(img, tuple(self.size), interpolation=cv2.INTER_AREA)
+        return img
+
+    def frames(self):
+        raise NotImplementedError
+
+    def cache_path(self):
+        # frames are stored raw in <cache>.u8, <cache>.json holds their shape
+        key = repr((os.path.abspath(self.name), self.size, self.gray, len(self)))
+        digest = hashlib.md5(key.encode()).hexdigest()[:12]
+        return os.path.join(self.cache_dir, f"frames_{digest}")
+
+    def __iter__(self):
+        if self.cache_dir is None or len(self) == 0:
+            yield from self.frames()
+            return
+
+        path = self.cache_path()
+        if os.path.exists(path + ".json"):
+            with open(path + ".json") as f:
+                shape = tuple(json.load(f)['shape'])
+            # copy-on-write, so the pipeline can still draw on the frames
+            cached = np.memmap(path + ".u8", dtype=np.uint8, mode='c', shape=shape)
+            for i in range(len(cached)):
+                yield cached[i]
+            return
+
+        yield from self._fill_cache(path)
+
+    def _fill_cache(self, path):
+        # Decode as usual while appending every frame to a temporary file.
+        # The frame count of a video is only an estimate, so the cache is
+        # sized by what was actually decoded once the sequence went through.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = path + ".u8.tmp"
+        shape = None
+        written = 0
+        reason = "stopped before the end of the sequence"
+        dropped = None
+        try:
+            with open(tmp_path, 'wb') as f:
+                for img in self.frames():
+                    if shape is None:
+                        shape = img.shape
+                    if dropped is None and img.shape != shape:
+                        dropped = f"frame {written} is {img.shape}, expected {shape}"
+                    if dropped is None:
+                        f.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+                        written += 1
+                    # frames keep coming even once the cache is given up
+                    yield img
+            reason = dropped or (None if written > 0 else "no frames")
+        finally:
+            if reason is None:
+                os.replace(tmp_path, path + ".u8")
+                with open(path + ".json", 'w') as f:
+                    json.dump({'shape': [written] + list(shape)}, f)
+            else:
+                print(f"Frame cache for {self.name} dropped: {reason}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+
+class VideoSource(FrameSource):
+    # Video file or camera device read through cv2.VideoCapture.
+    # A capture can only be read sequentially, so a single thread reads,
+    # converts and queues up to `prefetch` frames. A live camera does not
+    # wait for the consumer: when the queue is full the oldest frame goes.
+
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        cap = cv2.VideoCapture(path)
+        if not cap.isOpened():
+            raise IOError(f"Cannot open video {path}")
+        self.num_frames = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0)
+        cap.release()
+        self.queue = None
+
+    def __len__(self):
+        return self.num_frames
+
+    def backlog(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def frames(self):
+        q = self.queue = Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        live = self.num_frames == 0
+
+        error = [] # exception of the reader thread, raised again in the consumer
+
+        def reader():
+            cap = cv2.VideoCapture(self.name)
+            try:
+                while not stop.is_set() and cap.isOpened():
+                    ret, img = cap.read()
+                    if not ret:
+                        break
+                    timestamp = time.perf_counter()
+                    while live and q.full():
+                        try:
+                            q.get_nowait()
+                        except Empty:
+                            pass
+                    q.put((timestamp, self.prepare(img)))
+            except Exception as e:
+                error.append(e)
+            finally:
+                cap.release()
+                # the end marker always arrives, or the consumer would wait forever
+                q.put(None)
+
+        t = threading.Thread(target=reader, daemon=True)
+        t.start()
+        try:
+            while True:
+                item = q.get()
+                if item is None:
+                    if error:
+                        raise error[0]
+                    break
+                self.timestamp, img = item
+                yield img
+        finally:
+            # unblock the reader if the consumer stopped early
+            stop.set()
+            while t.is_alive():
+                while not q.empty():
+                    q.get()
+                t.join(timeout=0.01)
+
+
+class ImageSequenceSource(FrameSource):
+    # Folder of numbered images. Every image is independent, so they are
+    # decoded in parallel by a thread pool (cv2.imread releases the GIL).
+
+    def __init__(self, folder, pattern="*.png", **kwargs):
+        super().__init__(folder, **kwargs)
+        self.paths = sorted(glob.glob(os.path.join(folder, pattern)))
+        if not self.paths:
+            raise IOError(f"No {pattern} images in {folder}")
+
+    def __len__(self):
+        return len(self.paths)
+
+    def load(self, i):
+        # decoding straight to grayscale is cheaper than converting afterwards
+        flags = cv2.IMREAD_GRAYSCALE if self.gray else cv2.IMREAD_COLOR
+        return self.prepare(imread(self.paths[i], flags))
+
+    def frames(self):
+        n = len(self.paths)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque(pool.submit(self.load, i) for i in range(min(self.prefetch, n)))
+            next_i = len(pending)
+            try:
+                while pending:
+                    img = pending.popleft().result()
+                    if next_i < n:
+                        pending.append(pool.submit(self.load, next_i))
+                        next_i += 1
+                    yield img
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+class KittiSource(ImageSequenceSource):
+    # KITTI odometry sequence, e.g. data_odometry_gray/dataset/sequences/00.
+    # Reads image_<camera>/*.png and the P<camera> intrinsics from calib.txt,
+    # scaled to the output size. KITTI frames are much wider than 16:9, so only
+    # the width of `size` is used and the height keeps the native aspect ratio
+    # (`self.size` holds the resulting size).
+
+    def __init__(self, sequence_dir, camera=0, **kwargs):
+        super().__init__(os.path.join(sequence_dir, f"image_{camera}"), "*.png", **kwargs)
+
+        calib_lines = read_calibration_file(os.path.join(sequence_dir, "calib.txt"))
+        K = extract_intrinsic_matrix(calib_lines, camera_id=f"P{camera}")
+        if self.paths:
+            h, w = imread(self.paths[0], cv2.IMREAD_GRAYSCALE).shape
+            width = self.size[0] if self.size is not None else w
+            self.size = (width, int(round(h * width / w)))
+            if K is not None:
+                K = K.copy()
+                K[0] *= self.size[0] / w
+                K[1] *= self.size[1] / h
+        self.K = K
+
+
+def open_source(path, **kwargs):
+    """Pick the frame source for a video file, camera, KITTI sequence or image folder"""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No such video, camera or folder: {path}")
+    if os.path.isdir(path):
+        if os.path.exists(os.path.join(path, "calib.txt")):
+            return KittiSource(path, **kwargs)
+        return ImageSequenceSource(path, **kwargs)
+    return VideoSource(path, **kwargs)
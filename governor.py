@@ -0,0 +1,126 @@
+import math
+import time
+import cv2
+import numpy as np
+
+
+class Governor(object):
+    # Decides which frames the pipeline spends time on.
+    #
+    # - a frame is skipped when it barely differs from the last processed one
+    #   (small thumbnail, brightness offset removed, checked before any feature
+    #   extraction) and the last processed pair also had a low keypoint
+    #   parallax, so a slow but steady motion is never skipped
+    # - in realtime mode, a frame that is older than the latency budget is
+    #   dropped when a newer one is already waiting, so the pipeline always
+    #   works on the most recent image instead of falling further behind
+    # - with a budget, the cadence of the periodic stages (optimize, filter)
+    #   follows the measured stage costs so the average cost per frame fits
+    #   it; without one (offline runs) they keep their default cadence
+
+    def __init__(self, budget=None, realtime=False, min_motion=1.5, min_parallax=2.0,
+                 thumb_size=(64, 36), cadence=None, max_cadence=None, smoothing=0.1):
+        self.budget = budget # target seconds per frame, None for no latency constraint
+        self.realtime = realtime
+        self.min_motion = min_motion # mean absolute thumbnail difference, in gray levels
+        self.min_parallax = min_parallax # median keypoint displacement, in pixels
+        self.thumb_size = thumb_size
+        # cadence never gets below the default and never above the max
+        self.min_cadence = dict(cadence or {'optimize': 5, 'filter': 10})
+        self.max_cadence = dict(max_cadence or {stage: 10 * n for stage, n in self.min_cadence.items()})
+        self.cadence = dict(self.min_cadence)
+        self.smoothing = smoothing
+
+        self.since = {stage: 0 for stage in self.cadence} # processed frames since a stage last ran
+        self.cost = {} # stage -> moving average of its cost in seconds
+        self.last_thumb = None
+        self.frame_start = None
+        self.timestamp = None
+
+        self.processed = 0
+        self.skipped = 0 # negligible motion
+        self.dropped = 0 # stale under overload
+        self.motion = 0.0
+        self.parallax = None # of the last processed pair
+        self.frame_cost = None # moving average of the whole frame, in seconds
+        self.latency = None # moving average of capture to end of processing
+
+    def _average(self, old, new):
+        return new if old is None else (1 - self.smoothing) * old + self.smoothing * new
+
+    def admit(self, img, timestamp=None, backlog=0):
+        """Whether this frame should go through the pipeline"""
+        now = time.perf_counter()
+        if (self.realtime and self.budget is not None and timestamp is not None and backlog > 0
+                and now - timestamp > self.budget):
+            self.dropped += 1
+            return False
+
+        thumb = cv2.resize(img, self.thumb_size, interpolation=cv2.INTER_AREA).astype(np.float32)
+        # auto exposure shifts the whole image, that is not motion
+        thumb -= thumb.mean()
+        if self.last_thumb is not None and thumb.shape == self.last_thumb.shape:
+            self.motion = float(np.mean(np.abs(thumb - self.last_thumb)))
+            still = self.parallax is not None and self.parallax < self.min_parallax
+            if self.motion < self.min_motion and still:
+                self.skipped += 1
+                return False
+        self.last_thumb = thumb
+
+        self.processed += 1
+        for stage in self.since:
+            self.since[stage] += 1
+        self.frame_start = now
+        self.timestamp = timestamp
+        return True
+
+    def observe(self, stage, seconds):
+        self.cost[stage] = self._average(self.cost.get(stage), seconds)
+
+    def observe_parallax(self, pts1, pts2, focal):
+        # median displacement of the matched keypoints, in pixels
+        if len(pts1) > 0:
+            self.parallax = float(np.median(np.linalg.norm(pts1 - pts2, axis=1)) * focal)
+
+    def due(self, stage):
+        """Whether a periodic stage should run on this frame"""
+        if self.since[stage] < self.cadence[stage]:
+            return False
+        self.since[stage] = 0
+        return True
+
+    def finish(self):
+        # end of a processed frame: update the averages and the cadences
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.frame_cost = self._average(self.frame_cost, now - self.frame_start)
+        if self.timestamp is not None:
+            self.latency = self._average(self.latency, now - self.timestamp)
+
+        if self.budget is None:
+            return
+
+        # every frame pays for the other stages, the periodic stages share what is left
+        periodic = [stage for stage in self.cadence if stage in self.cost]
+        per_frame = sum(cost for stage, cost in self.cost.items() if stage not in self.cadence)
+        slack = self.budget - per_frame
+        for stage in periodic:
+            if slack <= 0:
+                n = self.max_cadence[stage]
+            else:
+                n = math.ceil(self.cost[stage] / (slack / len(periodic)))
+            self.cadence[stage] = min(max(n, self.min_cadence[stage]), self.max_cadence[stage])
+
+    def stats(self):
+        return {
+            'processed': self.processed,
+            'skipped': self.skipped,
+            'dropped': self.dropped,
+            'motion': self.motion,
+            'parallax': self.parallax or 0.0,
+            'frame_cost': self.frame_cost or 0.0,
+            'latency': self.latency or 0.0,
+            'budget': self.budget,
+            'cadence': dict(self.cadence),
+            'stage_cost': dict(self.cost),
+        }
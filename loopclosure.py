@@ -0,0 +1,416 @@
+import bisect
+import cv2
+import numpy as np
+import g2o
+from extractor import fit_fundamental, extractPose
+
+# number of set bits for every possible byte value, used for hamming distances
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hamming(des, centers):
+    # Hamming distance between N binary descriptors (N x 32) and
+    # either a shared set of centers (k x 32) or one set per descriptor (N x k x 32).
+    # Returns an N x k matrix.
+    return _POPCOUNT[np.bitwise_xor(des[:, None, :], centers)].sum(axis=-1, dtype=np.int32)
+
+
+class Vocabulary(object):
+    # Vocabulary tree over binary ORB descriptors (bag of binary words).
+    # Each level splits a node into `k` children with k-majority clustering,
+    # so a descriptor is quantized into one of k**levels words with only
+    # k * levels hamming distances instead of a search over every word.
+
+    def __init__(self, k=10, levels=6):
+        self.k = k
+        self.levels = levels
+        self.centers = [] # per level: (k**level, k, 32) children centers of every node
+        self.idf = None # inverse document frequency weight of every word
+
+    @property
+    def num_words(self):
+        return self.k ** self.levels
+
+    def _cluster(self, des, rng, iterations=10):
+        # k-majority: like k-means, but the center of a cluster of binary
+        # descriptors is the bitwise majority vote of its members.
+        if len(des) <= self.k:
+            centers = np.repeat(des[:1], self.k, axis=0)
+            centers[:len(des)] = des
+            return centers, np.arange(len(des))
+
+        centers = des[rng.choice(len(des), self.k, replace=False)]
+        bits = np.unpackbits(des, axis=1)
+        for _ in range(iterations):
+            assign = hamming(des, centers).argmin(axis=1)
+            new_centers = centers.copy()
+            for j in range(self.k):
+                members = assign == j
+                if members.any():
+                    new_centers[j] = np.packbits(bits[members].mean(axis=0) > 0.5)
+            if np.array_equal(new_centers, centers):
+                break
+            centers = new_centers
+        return centers, hamming(des, centers).argmin(axis=1)
+
+    def train(self, descriptors, max_descriptors=100000, seed=0):
+        """Build the tree from a list of per-frame descriptor arrays"""
+        rng = np.random.default_rng(seed)
+        des = np.concatenate([d for d in descriptors if d is not None])
+        if len(des) > max_descriptors:
+            des = des[rng.choice(len(des), max_descriptors, replace=False)]
+
+        # breadth first: split every node of a level into k children
+        members = {0: np.arange(len(des))}
+        self.centers = []
+        for level in range(self.levels):
+            centers = np.zeros((self.k ** level, self.k, des.shape[1]), dtype=np.uint8)
+            next_members = {}
+            for node, idx in members.items():
+                if len(idx) == 0:
+                    continue
+                centers[node], assign = self._cluster(des[idx], rng)
+                for j in range(self.k):
+                    next_members[node * self.k + j] = idx[assign == j]
+            self.centers.append(centers)
+            members = next_members
+
+        # idf: words that show up in every training frame carry no information
+        frames_with_word = np.zeros(self.num_words)
+        frames = [d for d in descriptors if d is not None and len(d) > 0]
+        for d in frames:
+            frames_with_word[np.unique(self.words(d))] += 1
+        self.idf = np.log(len(frames) / np.maximum(frames_with_word, 1))
+
+    def words(self, des):
+        # descend the tree, keeping one node per descriptor
+        node = np.zeros(len(des), dtype=np.int64)
+        for centers in self.centers:
+            node = node * self.k + hamming(des, centers[node]).argmin(axis=1)
+        return node
+
+    def transform(self, des):
+        # tf-idf weighted, L1 normalized bag of words vector, as (words, weights)
+        words, counts = np.unique(self.words(des), return_counts=True)
+        weights = counts / len(des) * self.idf[words]
+        keep = weights > 0
+        words, weights = words[keep], weights[keep]
+        if weights.sum() > 0:
+            weights /= weights.sum()
+        return words, weights
+
+    def save(self, path):
+        np.savez(path, k=self.k, levels=self.levels, idf=self.idf,
+                 **{'level_%d' % i: c for i, c in enumerate(self.centers)})
+
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        vocab = Vocabulary(int(data['k']), int(data['levels']))
+        vocab.centers = [data['level_%d' % i] for i in range(vocab.levels)]
+        vocab.idf = data['idf']
+        return vocab
+
+
+def bow_score(bow1, bow2):
+    # L1 similarity of two normalized bag of words vectors, in [0, 1]
+    words1, weights1 = bow1
+    words2, weights2 = bow2
+    _, i1, i2 = np.intersect1d(words1, words2, assume_unique=True, return_indices=True)
+    v, w = weights1[i1], weights2[i2]
+    return 0.5 * np.sum(v + w - np.abs(v - w))
+
+
+class KeyframeDatabase(object):
+    # Inverted index from words to the keyframes that contain them.
+    # A query only visits the keyframes sharing at least one word with
+    # the query, instead of comparing against every keyframe of the map.
+    # Postings only exist for words that were seen, as numpy arrays that
+    # double in size when full. Words in more than `max_postings` keyframes
+    # are stop words: they say little about the place and would make every
+    # query scan a share of the whole map, so queries ignore them.
+
+    def __init__(self, max_postings=2000, capacity=16):
+        self.postings = {} # word -> [frame ids, weights, used length]
+        self.max_postings = max_postings
+        self.capacity = capacity
+
+    def add(self, frame_id, bow):
+        for word, weight in zip(*bow):
+            posting = self.postings.get(word)
+            if posting is None:
+                posting = self.postings[word] = [np.empty(self.capacity, dtype=np.int32),
+                                                 np.empty(self.capacity, dtype=np.float32), 0]
+            ids, weights, n = posting
+            if n == len(ids):
+                posting[0] = ids = np.resize(ids, 2 * n)
+                posting[1] = weights = np.resize(weights, 2 * n)
+            ids[n] = frame_id
+            weights[n] = weight
+            posting[2] = n + 1
+
+    def query(self, bow, max_frame_id, max_results=5):
+        """Return [(frame id, score)] of the best keyframes with id < max_frame_id"""
+        if max_frame_id <= 0:
+            return []
+        ids, contrib = [], []
+        for word, v in zip(*bow):
+            posting = self.postings.get(word)
+            if posting is None or posting[2] > self.max_postings:
+                continue
+            # frame ids are added in increasing order, so the recent ones are at the end
+            n = np.searchsorted(posting[0][:posting[2]], max_frame_id)
+            w = posting[1][:n]
+            ids.append(posting[0][:n])
+            # L1 score, accumulated over the common words only
+            contrib.append(v + w - np.abs(v - w))
+        if not ids:
+            return []
+
+        # scores only for the keyframes that were touched
+        touched, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        if len(touched) == 0:
+            return []
+        scores = 0.5 * np.bincount(inverse, weights=np.concatenate(contrib))
+        best = np.argpartition(-scores, min(max_results, len(scores)) - 1)[:max_results]
+        best = best[np.argsort(-scores[best])]
+        return [(int(touched[i]), scores[i]) for i in best if scores[i] > 0]
+
+
+class LoopCloser(object):
+    # Place recognition + loop correction for the global map.
+    # Every frame is turned into a bag of words vector and looked up in the
+    # keyframe database. Candidates are verified with a fundamental matrix fit,
+    # then the trajectory is corrected with a pose graph and the points seen
+    # again are merged into the ones already in the map.
+    #
+    # Only keyframes go into the database: a frame whose words are still
+    # close to the last keyframe's (score above `keyframe_similarity`) would
+    # just repeat it. A candidate is only verified once it has been returned
+    # for `min_consistency` consecutive frames (each time within
+    # `consistency_window` keyframes of the previous candidate), and after an
+    # accepted loop detection pauses for `cooldown` frames, so driving
+    # through a revisited area closes the loop once.
+
+    def __init__(self, mapp, vocabulary=None, train_frames=100, min_loop_gap=50,
+                 min_score_ratio=0.75, min_inliers=40, min_consistency=3,
+                 consistency_window=3, cooldown=30, keyframe_similarity=0.3,
+                 verbose=True):
+        self.mapp = mapp
+        if isinstance(vocabulary, str):
+            vocabulary = Vocabulary.load(vocabulary)
+        self.vocabulary = vocabulary
+        self.database = KeyframeDatabase()
+        self.train_frames = train_frames # frames to collect before training a vocabulary on the fly
+        self.min_loop_gap = min_loop_gap # recent frames that are never loop candidates
+        self.min_score_ratio = min_score_ratio # relative to the score against the previous frame
+        self.min_inliers = min_inliers
+        self.min_consistency = min_consistency
+        self.consistency_window = consistency_window # keyframes closer than this are the same place
+        self.keyframe_similarity = keyframe_similarity
+        self.verbose = verbose
+        self.cooldown = cooldown
+        self.consistent = {} # candidate id -> consecutive frames it was seen for
+        self.last_loop = -cooldown # frame id of the last accepted loop
+        self.keyframes = [] # frame ids in the database, in insertion order
+        self.last_keyframe_bow = None
+        self.last_bow = None # of the previous frame
+        self.pending = [] # frames waiting for the vocabulary to be trained
+        self.loops = [] # (loop frame id, current frame id, relative pose) constraints
+
+    def _add(self, frame, bow):
+        if self.last_keyframe_bow is not None and \
+                bow_score(bow, self.last_keyframe_bow) > self.keyframe_similarity:
+            return
+        self.database.add(frame.id, bow)
+        self.keyframes.append(frame.id)
+        self.last_keyframe_bow = bow
+
+    def _ordinal(self, frame_id):
+        # position of a keyframe in the database
+        return bisect.bisect_left(self.keyframes, frame_id)
+
+    def process(self, frame):
+        """Index the frame and close a loop if it revisits a known place"""
+        if frame.des is None or len(frame.des) == 0:
+            return None
+
+        if self.vocabulary is None:
+            self.pending.append(frame)
+            if len(self.pending) < self.train_frames:
+                return None
+            self.vocabulary = Vocabulary()
+            self.vocabulary.train([f.des for f in self.pending])
+            for f in self.pending:
+                self.last_bow = self.vocabulary.transform(f.des)
+                self._add(f, self.last_bow)
+            self.pending = []
+            return None
+
+        bow = self.vocabulary.transform(frame.des)
+        # the previous frame gives the score a true revisit should reach
+        prev_score = bow_score(bow, self.last_bow) if self.last_bow is not None else 0
+        min_score = self.min_score_ratio * prev_score
+        self.last_bow = bow
+
+        self._add(frame, bow)
+        if frame.id - self.last_loop < self.cooldown:
+            self.consistent = {}
+            return None
+
+        candidates = [cand_id for cand_id, score in self.database.query(bow, frame.id - self.min_loop_gap)
+                      if score >= min_score]
+
+        # temporal consistency: the previous frame should have had a candidate nearby
+        consistent = {}
+        for cand_id in candidates:
+            previous = [count for prev_id, count in self.consistent.items()
+                        if abs(self._ordinal(prev_id) - self._ordinal(cand_id)) <= self.consistency_window]
+            consistent[cand_id] = 1 + max(previous, default=0)
+        self.consistent = consistent
+
+        for cand_id in candidates:
+            if consistent[cand_id] < self.min_consistency:
+                continue
+            loop = self.mapp.frames[cand_id]
+            verified = self.verify(frame, loop)
+            if verified is None:
+                continue
+            idx1, idx2, Rt = verified
+            if self.verbose:
+                print(f"Loop detected: frame {frame.id} -> frame {loop.id} ({len(idx1)} inliers)")
+            # An edge along the same revisit as a recent loop (same frame offset, shortly
+            # after it) adds no correction worth rebuilding the pose graph for.
+            known = any(abs((cur_id - loop_id) - (frame.id - loop.id)) <= self.cooldown and
+                        frame.id - cur_id <= 2 * self.cooldown for loop_id, cur_id, _ in self.loops)
+            self.loops.append((loop.id, frame.id, Rt))
+            if not known:
+                self.correct_poses()
+            self.merge_points(frame, loop, idx1, idx2)
+            self.last_loop = frame.id
+            self.consistent = {}
+            return loop
+        return None
+
+    def verify(self, f1, f2):
+        # Same matching as `match_frames`, without the small motion prior
+        # since a revisit can be anywhere in the image.
+        bf = cv2.BFMatcher(cv2.NORM_HAMMING)
+        matches = bf.knnMatch(f1.des, f2.des, k=2)
+
+        ret = []
+        idx1, idx2 = [], []
+        for m_n in matches:
+            if len(m_n) < 2:
+                continue
+            m, n = m_n
+            if m.distance < 0.75*n.distance:
+                idx1.append(m.queryIdx)
+                idx2.append(m.trainIdx)
+                ret.append((f1.pts[m.queryIdx], f2.pts[m.trainIdx]))
+
+        if len(ret) < self.min_inliers:
+            return None
+        ret = np.array(ret)
+
+        model, inliers = fit_fundamental(ret)
+        if model is None or inliers is None or np.sum(inliers) < self.min_inliers:
+            return None
+        try:
+            Rt = extractPose(model.params, verbose=False)
+        except AssertionError:
+            return None
+        return np.array(idx1)[inliers], np.array(idx2)[inliers], Rt
+
+    def correct_poses(self, iterations=20):
+        """Pose graph over odometry and loop edges, then move the points along"""
+        frames = self.mapp.frames
+        optimizer = g2o.SparseOptimizer()
+        solver = g2o.BlockSolverSE3(g2o.LinearSolverEigenSE3())
+        optimizer.set_algorithm(g2o.OptimizationAlgorithmLevenberg(solver))
+
+        # vertices hold camera-to-world transforms, frame.pose is world-to-camera
+        old = [np.linalg.inv(f.pose) for f in frames]
+        for f, X in zip(frames, old):
+            v = g2o.VertexSE3()
+            v.set_id(f.id)
+            v.set_estimate(g2o.Isometry3d(X[:3, :3], X[:3, 3]))
+            v.set_fixed(f.id == 0)
+            optimizer.add_vertex(v)
+
+        def add_edge(i, j, measurement):
+            e = g2o.EdgeSE3()
+            e.set_vertex(0, optimizer.vertex(i))
+            e.set_vertex(1, optimizer.vertex(j))
+            e.set_measurement(g2o.Isometry3d(measurement[:3, :3], measurement[:3, 3]))
+            e.set_information(np.identity(6))
+            optimizer.add_edge(e)
+
+        # odometry edges keep the current relative motion between consecutive frames
+        for i in range(1, len(frames)):
+            add_edge(i - 1, i, np.dot(np.linalg.inv(old[i - 1]), old[i]))
+
+        # cur.pose = Rt . loop.pose, so the loop edge from loop to cur is inv(Rt)
+        for loop_id, cur_id, Rt in self.loops:
+            add_edge(loop_id, cur_id, np.linalg.inv(Rt))
+
+        optimizer.initialize_optimization()
+        optimizer.optimize(iterations)
+
+        new = [optimizer.vertex(f.id).estimate().matrix() for f in frames]
+        for f, X in zip(frames, new):
+            f.pose = np.linalg.inv(X)
+
+        # each point follows the correction of the first frame that observed it
+        for point in self.mapp.points:
+            i = point.frames[0].id
+            correction = np.dot(new[i], np.linalg.inv(old[i]))
+            point.pt = np.dot(correction, np.append(point.pt[:3], 1))
+
+    def merge_points(self, f1, f2, idx1, idx2):
+        """Fuse the points of f1 into the points of f2 that see the same keypoints"""
+        alive = set(id(p) for p in self.mapp.points)
+        removed = set()
+        for i1, i2 in zip(idx1, idx2):
+            p1 = f1.map_points.get(i1)
+            p2 = f2.map_points.get(i2)
+            if p1 is None or p2 is None or p1 is p2:
+                continue
+            if id(p1) not in alive or id(p2) not in alive or id(p1) in removed:
+                continue
+            for frame, idx in zip(p1.frames, p1.idxs):
+                p2.add_observation(frame, idx)
+            removed.add(id(p1))
+
+        if removed:
+            self.mapp.points = [p for p in self.mapp.points if id(p) not in removed]
+            if self.verbose:
+                print(f"Merged {len(removed)} duplicate map points")
+
+
+def main():
+    # Train a vocabulary offline, so the pipeline does not stall on the
+    # first frames training its own:
+    #   python loopclosure.py vocabulary.npz car.mp4 [more sequences...]
+    import sys
+    from extractor import extract
+    from framesource import open_source
+
+    out_path, paths = sys.argv[1], sys.argv[2:]
+    descriptors = []
+    for path in paths:
+        for i, img in enumerate(open_source(path, size=(1920//2, 1080//2))):
+            # neighbouring frames look alike, every 10th one is enough
+            if i % 10 == 0:
+                _, des = extract(img)
+                if des is not None:
+                    descriptors.append(des)
+
+    vocab = Vocabulary()
+    vocab.train(descriptors)
+    vocab.save(out_path)
+    print(f"Vocabulary with {vocab.num_words} words from {len(descriptors)} frames saved to {out_path}")
+
+
+if __name__ == "__main__":
+    main()
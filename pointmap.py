@@ -297,4 +297,5 @@ class Point(object):
         # Frame is the frame class
         self.frames.append(frame)
         self.idxs.append(idx)
+        frame.map_points[idx] = self
 
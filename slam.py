@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import random
+from collections import defaultdict
+from contextlib import contextmanager
+import cv2
+import numpy as np
+from extractor import Frame, denormalize, match_frames, add_ones
+from pointmap import Map, Point
+from loopclosure import LoopCloser
+from governor import Governor
+
+
+def triangulate(pose1, pose2, pts1, pts2):
+    ret = np.zeros((pts1.shape[0], 4))
+    pose1 = np.linalg.inv(pose1)
+    pose2 = np.linalg.inv(pose2)
+    for i, p in enumerate(zip(add_ones(pts1), add_ones(pts2))):
+        A = np.zeros((4, 4))
+        A[0] = p[0][0] * pose1[2] - pose1[0]
+        A[1] = p[0][1] * pose1[2] - pose1[1]
+        A[2] = p[1][0] * pose2[2] - pose2[0]
+        A[3] = p[1][1] * pose2[2] - pose2[1]
+        _, _, vt = np.linalg.svd(A)
+        ret[i] = vt[3]
+
+    return ret
+
+def ransac_plane_fitting(points, threshold=0.1, max_iterations=1000):
+    best_plane = None
+    best_inliers = []
+
+    for _ in range(max_iterations):
+        # Randomly sample 3 points
+        sample_indices = random.sample(range(points.shape[0]), 3)
+        sample_points = points[sample_indices]
+
+        # Fit a plane to these 3 points
+        p1, p2, p3 = sample_points
+        normal = np.cross(p2 - p1, p3 - p1)
+        normal = normal / np.linalg.norm(normal)
+        d = -np.dot(normal, p1)
+        plane = np.append(normal, d)
+
+        # Calculate distances of all points to the plane
+        distances = np.abs(np.dot(points, normal) + d)
+
+        # Identify inliers
+        inliers = np.where(distances < threshold)[0]
+
+        # Update the best plane if this one has more inliers
+        if len(inliers) > len(best_inliers):
+            best_plane = plane
+            best_inliers = inliers
+
+    return best_plane, best_inliers
+
+
+class SLAM(object):
+    # One run of the pipeline over one sequence: the map, the loop closer,
+    # the frame counter and the camera intrinsics all live here, so several
+    # sequences can be processed in the same program (see batch.py).
+    # With viewer=False nothing is drawn or sent to the pangolin viewer, and
+    # unless verbose=True nothing is printed per frame either.
+    # The governor decides which frames are processed and how often the
+    # periodic stages run (see governor.py). `vocabulary` is a pretrained
+    # loopclosure.Vocabulary or the path of one, otherwise the loop closer
+    # trains its own on the first frames.
+
+    def __init__(self, W, H, K, viewer=True, loop_closure=True, governor=None, vocabulary=None,
+                 verbose=None):
+        self.W, self.H = W, H
+        self.K = K
+        self.Kinv = np.linalg.inv(K)
+        self.viewer = viewer
+        self.verbose = viewer if verbose is None else verbose
+
+        self.mapp = Map()
+        if viewer:
+            self.mapp.create_viewer()
+        self.loop_closer = LoopCloser(self.mapp, vocabulary, verbose=self.verbose) if loop_closure else None
+        self.governor = governor if governor is not None else Governor()
+
+        self.frame_counter = 0
+        self.timings = defaultdict(float) # stage -> total seconds spent in it
+        self.start_time = None
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        self.timings[stage] += seconds
+        self.governor.observe(stage, seconds)
+
+    def stats(self):
+        """Counters and per-stage timings of the run so far"""
+        elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+        return {
+            'frames': self.frame_counter,
+            'keyframes': len(self.mapp.frames),
+            'points': len(self.mapp.points),
+            'loops': len(self.loop_closer.loops) if self.loop_closer is not None else 0,
+            'elapsed': elapsed,
+            'fps': self.frame_counter / elapsed if elapsed > 0 else 0.0,
+            'stages': {stage: {'total': t, 'per_frame_ms': 1000 * t / max(self.frame_counter, 1)}
+                       for stage, t in self.timings.items()},
+            'governor': self.governor.stats(),
+        }
+
+    def trajectory(self):
+        # camera-to-world poses, one 3x4 matrix per input frame (KITTI poses format).
+        # Frames the governor skipped or dropped repeat the last processed pose.
+        poses = []
+        pose = np.eye(4)
+        frames = iter(self.mapp.frames)
+        f = next(frames, None)
+        for index in range(self.frame_counter):
+            while f is not None and (f.index is None or f.index <= index):
+                pose = f.pose
+                f = next(frames, None)
+            poses.append(np.linalg.inv(pose)[:3].flatten())
+        return np.array(poses)
+
+    def save(self, out_dir):
+        # stats first: they are what tells a failed run apart
+        os.makedirs(out_dir, exist_ok=True)
+        with open(os.path.join(out_dir, "stats.json"), 'w') as f:
+            json.dump(self.stats(), f, indent=2)
+        np.save(os.path.join(out_dir, "map_points.npy"),
+                np.array([point.pt[:3] for point in self.mapp.points]))
+        np.savetxt(os.path.join(out_dir, "trajectory.txt"), self.trajectory())
+
+    def process_frame(self, img, timestamp=None, backlog=0):
+        # timestamp: capture time (time.perf_counter) of the frame, if known
+        # backlog: number of newer frames already waiting behind this one
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+
+        self.frame_counter += 1
+
+        if not self.governor.admit(img, timestamp, backlog):
+            return
+
+        try:
+            self.track(img)
+        finally:
+            self.governor.finish()
+
+    def track(self, img):
+        mapp, K = self.mapp, self.K
+
+        if (img.shape[1], img.shape[0]) != (self.W, self.H):
+            img = cv2.resize(img, (self.W, self.H))
+        with self.timed('extract'):
+            frame = Frame(mapp, img, K, index=self.frame_counter - 1)
+        if frame.id == 0:
+            return
+
+        # previous frame f2 to the current frame f1.
+        f1 = mapp.frames[-1]
+        f2 = mapp.frames[-2]
+
+        with self.timed('match'):
+            idx1, idx2, Rt = match_frames(f1, f2, self.verbose)
+        if self.verbose:
+            print(f"=------------Rt {Rt}")
+        self.governor.observe_parallax(f1.pts[idx1], f2.pts[idx2], K[0, 0])
+        # f2.pose represents the transformation from the world coordinate system to the coordinate system of the previous frame f2.
+        # Rt represents the transformation from the coordinate system of f2 to the coordinate system of f1.
+        # By multiplying Rt with f2.pose, you get a new transformation that directly maps the world coordinate system to the coordinate system of f1.
+        f1.pose = np.dot(Rt, f2.pose)
+
+        with self.timed('triangulate'):
+            # The output is a matrix where each row is a 3D point in homogeneous coordinates [𝑋, 𝑌, 𝑍, 𝑊]
+            pts4d = triangulate(f1.pose, f2.pose, f1.pts[idx1], f2.pts[idx2])
+
+            # This line normalizes the 3D points by dividing each row by its fourth coordinate W
+            # The homogeneous coordinates [𝑋, 𝑌, 𝑍, 𝑊] are converted to Euclidean coordinates
+            pts4d /= pts4d[:, 3:]
+
+            good_pts4d = (np.abs(pts4d[:, 3]) > 0.001) #  & (pts4d[:, 2] > 0)
+
+            latest_cam_pos = f1.pose[:3, 3]
+            distance_from_camera = np.linalg.norm(pts4d[:, :3] - latest_cam_pos, axis=1)
+            good_pts4d = good_pts4d & (distance_from_camera < 20)
+
+            for i, p in enumerate(pts4d):
+                #  If the point is not good (i.e., good_pts4d[i] is False), the loop skips the current iteration and moves to the next point.
+                if not good_pts4d[i]:
+                    continue
+                pt = Point(mapp, p)
+                pt.add_observation(f1, idx1[i])
+                pt.add_observation(f2, idx2[i])
+
+        # Place recognition: corrects the drift and merges duplicate points on a revisit
+        if self.loop_closer is not None:
+            with self.timed('loop_closure'):
+                self.loop_closer.process(f1)
+
+        if len(mapp.frames) >= 3 and self.governor.due('optimize'):
+            with self.timed('optimize'):
+                mapp.optimize()
+
+        if(len(mapp.points) > 50 and self.governor.due('filter')):
+            with self.timed('filter'):
+                mapp.filter_by_reprojection_error(K,3.0)
+                # mapp.remove_radius_outliers(radius=1.0, min_neighbors=2)
+                mapp.downsample(voxel_size=0.1)
+
+        # The road plane and the overlays are only used for visualization
+        if not self.viewer:
+            return
+
+        with self.timed('display'):
+            self.draw(img, f1, f2, idx1, idx2)
+
+    def draw(self, img, f1, f2, idx1, idx2):
+        mapp, K = self.mapp, self.K
+
+        # frame sources deliver grayscale, the overlays below are drawn in color
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+        points = np.array([point.pt[:3] for point in mapp.points])
+        # points = pre_filter_points(points)
+
+
+        plane, inliers = ransac_plane_fitting(points)
+
+        mapp.inliers = inliers
+        mapp.plane = plane
+
+        if self.verbose:
+            print(f"RANSAC plane: {plane}")
+            print(f"Number of inliers: {len(inliers)}")
+
+        road_points = points[inliers]
+        non_road_points = np.delete(points, inliers, axis=0)
+
+        for pt in road_points:
+            u, v = denormalize(K, pt[:2])
+            cv2.circle(img, (u, v), 2, (0, 255, 0), -1)  # Green for inliers
+
+        # Visualize the non-road points (outliers)
+        for pt in non_road_points:
+            u, v = denormalize(K, pt[:2])
+            cv2.circle(img, (u, v), 2, (0, 0, 255), -1)  # Red for outliers
+
+        # Draw the plane (optional)
+        if plane is not None:
+            normal = plane[:3]
+            d = plane[3]
+            # Draw the plane as a grid of points
+            for x in range(-10, 10):
+                for y in range(-10, 10):
+                    z = (-d - normal[0] * x - normal[1] * y) / normal[2]
+                    pt = np.array([x, y, z])
+                    u, v = denormalize(K, pt[:2])
+                    cv2.circle(img, (u, v), 1, (255, 255, 0), -1)  # Yellow for plane points
+
+        for pt1, pt2 in zip(f1.pts[idx1], f2.pts[idx2]):
+            u1, v1 = denormalize(K, pt1)
+            u2, v2 = denormalize(K, pt2)
+
+            cv2.circle(img, (u1,v1), 2, (77, 243, 255))
+
+            cv2.line(img, (u1,v1), (u2, v2), (255,0,0))
+            cv2.circle(img, (u2, v2), 2, (204, 77, 255))
+
+
+        # 2-D display
+        #img = cv2.resize(img, ( 320, 180))
+        #display.paint(img)
+
+        # 3-D display
+        mapp.display()
+        mapp.display_image(img)